@@ -21,16 +21,28 @@ from __future__ import absolute_import
 
 from numpy import asarray
 
+from gp_align import kernels
+
 
 RADIUS = 20
 
 
-def align_plates(plate_image, calibration_plate):
+def align_plates(plate_image, calibration_plate, backend="numpy"):
     """
     Compute a translation between plate image and calibration image.
 
     Both images should be converted to edges.
 
+    Parameters
+    ----------
+    plate_image : numpy.array
+        Boolean edge image of the analyzed plate.
+    calibration_plate : numpy.array
+        Boolean edge image of the calibration plate.
+    backend : {"auto", "numpy", "numba"}, optional
+        Which implementation to use (see `gp_align.kernels`). All backends
+        return identical results.
+
     Returns
     -------
     numpy.array
@@ -38,6 +50,8 @@ def align_plates(plate_image, calibration_plate):
         plate to the analyzed plate.
     """
     r = int(RADIUS)
+    if kernels.resolve_backend(backend) == "numba":
+        return kernels.align_plates(plate_image, calibration_plate, r)
     best_offset = (0, 0)
     best_value = 0
     for i in range(-r, r + 1):
@@ -50,16 +64,20 @@ def align_plates(plate_image, calibration_plate):
     return asarray(best_offset)
 
 
-def compare_images(image1, image2, x, y):
+def compare_images(image1, image2, x, y, backend="numpy"):
     """
     Find the overlap of white pixels between two images with offset.
 
+    The optional *backend* is interpreted as in `align_plates`.
+
     Returns
     -------
     int
         The number of pixels where both images are True/white/on when they are
         overlapped with the given offset (x, y).
     """
+    if kernels.resolve_backend(backend) == "numba":
+        return kernels.compare_images(image1, image2, x, y)
     shape1 = image1.shape
     shape2 = image2.shape
     image1_slice = image1[
@@ -22,6 +22,8 @@ from __future__ import absolute_import
 import json
 import logging
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+from os import getpid
 from os.path import basename, splitext
 from sys import float_info
 
@@ -35,12 +37,16 @@ from tqdm import tqdm
 from importlib_resources import open_binary, path
 
 import gp_align.data
+from gp_align import kernels
 from gp_align.align import align_plates
 from gp_align.parse_time import fix_date, convert_to_datetime
+from gp_align.screen import configure_screen, screen_files, screen_image
 from gp_align.util import well_names, cut_image
 
 LOGGER = logging.getLogger(__name__)
 CANNY_SIGMA = 1.0
+# Per-process thread pool that is reused across images, see `get_thread_pool`.
+_THREAD_POOL = {"pid": None, "size": 0, "pool": None}
 PLATES = {
     1: ["tray1", "tray2", "tray3", "tray4", "tray5", "tray6"],
     2: ["tray7", "tray8", "tray9", "tray10", "tray11", "tray12"]
@@ -48,7 +54,9 @@ PLATES = {
 
 
 def analyze_run(images, scanner=1, plate_type=1, orientation="top-right",
-                plates=None, unit="h", parse_timestamps=True, num_proc=1):
+                plates=None, unit="h", parse_timestamps=True, num_proc=1,
+                backend="auto", num_threads=1, prescreen=True,
+                screen_rules=None):
     """
     Analyse a list of images from the Growth Profiler.
 
@@ -72,13 +80,42 @@ def analyze_run(images, scanner=1, plate_type=1, orientation="top-right",
         Whether or not to parse the image names as timestamps.
     num_proc : int, optional
         Number of processes to use for the calculations.
+    backend : {"auto", "numpy", "numba"}, optional
+        Which implementation of the numeric kernels to use. "auto" prefers
+        the compiled numba kernels when numba is installed.
+    num_threads : int, optional
+        Number of threads per process used to analyze the trays of one
+        image concurrently. This reduces the latency for few images.
+        Together with *num_proc* it is capped at the number of cores.
+    prescreen : bool, optional
+        Whether to skip blank, duplicate or corrupt images before analyzing
+        them. Rejected images are logged together with the reason.
+    screen_rules : dict, optional
+        Rules that override `gp_align.screen.DEFAULT_RULES`.
     """
     unit = Timedelta(1, unit=unit)
+    backend = kernels.resolve_backend(backend)
     config = configure_run(scanner, plate_type, plates, orientation,
                            parse_timestamps)
+    config["backend"] = backend
+    LOGGER.debug("Using the '%s' backend.", config["backend"])
 
-    data = dict()
     LOGGER.info("%d images in the series.", len(images))
+    if prescreen:
+        config["screen_rules"] = configure_screen(screen_rules)
+        images, rejected = screen_files(
+            images, config["screen_rules"],
+            key=lambda f: chronological_key(f, parse_timestamps))
+        for filename, reason in rejected:
+            LOGGER.warning("Image '%s' was rejected: %s.", filename, reason)
+    else:
+        config["screen_rules"] = None
+
+    num_proc, config["num_threads"] = plan_workers(
+        len(images), len(config["plate_names"]), num_proc, num_threads)
+
+    data = dict()
+    num_rejected = 0
     pool = multiprocessing.Pool(processes=num_proc)
     LOGGER.debug("Submitting tasks...")
     result_iter = pool.imap_unordered(analyze_image,
@@ -89,11 +126,18 @@ def analyze_run(images, scanner=1, plate_type=1, orientation="top-right",
             if "error" in res:
                 LOGGER.error("Image '%s' produced the following error: %s.",
                              res["filename"], res["error"])
+            elif "rejected" in res:
+                LOGGER.warning("Image '%s' was rejected: %s.",
+                               res["filename"], res["rejected"])
+                num_rejected += 1
             else:
                 for plate, row in iteritems(res):
                     data.setdefault(plate, list()).append(row)
             pbar.update()
     pool.join()
+    if prescreen:
+        LOGGER.info("%d images were rejected by the pre-screen.",
+                    len(rejected) + num_rejected)
 
     for plate, plate_data in iteritems(data):
         LOGGER.debug("Plate '%s' has %d rows and %d columns.",
@@ -117,6 +161,41 @@ def analyze_run(images, scanner=1, plate_type=1, orientation="top-right",
     return output
 
 
+def chronological_key(filename, parse_dates):
+    """Sort images by their timestamp or, if that fails, by their name."""
+    name = splitext(basename(filename))[0]
+    if parse_dates:
+        try:
+            return 0, convert_to_datetime(fix_date(name))
+        except ValueError:
+            pass
+    return 1, name
+
+
+def plan_workers(num_images, num_plates, num_proc, num_threads):
+    """
+    Balance the number of processes and threads per process.
+
+    Never use more processes than there are images nor more threads than
+    there are plates. If processes times threads exceed the number of cores,
+    the threads are reduced since the process-level parallelism is more
+    efficient for long series.
+    """
+    num_proc = max(1, min(num_proc, num_images))
+    num_threads = max(1, min(num_threads, num_plates))
+    try:
+        num_cpu = multiprocessing.cpu_count()
+    except NotImplementedError:
+        num_cpu = 1
+    if num_threads > 1 and num_proc * num_threads > num_cpu:
+        num_threads = max(1, num_cpu // num_proc)
+        LOGGER.warning("Reducing to %d thread(s) per process in order not to "
+                       "oversubscribe %d cores.", num_threads, num_cpu)
+    LOGGER.debug("Using %d process(es) with %d thread(s) each.", num_proc,
+                 num_threads)
+    return num_proc, num_threads
+
+
 def configure_run(scanner, plate_type, plates, orientation, parse_dates):
     config = dict()
     config["parse_dates"] = parse_dates
@@ -175,9 +254,6 @@ def analyze_image(args):
     """Analyze all wells from all trays in one image."""
     filename, config = args
     LOGGER.debug(filename)
-    rows = config["rows"]
-    columns = config["columns"]
-    well_names = config["well_names"]
 
     name = splitext(basename(filename))[0]
     if config["parse_dates"]:
@@ -193,42 +269,91 @@ def analyze_image(args):
     except OSError as err:
         return {"error": str(err), "filename": filename}
 
+    if config.get("screen_rules") is not None:
+        reason = screen_image(image, config["screen_rules"])
+        if reason is not None:
+            return {"rejected": reason, "filename": filename}
+
     plate_images = cut_image(image)
 
+    tasks = [(plate_images[i], i, plate_name, index, config)
+             for i, plate_name in zip(config["plate_indexes"],
+                                      config["plate_names"])]
+    num_threads = min(config.get("num_threads", 1), len(tasks))
+    if num_threads > 1:
+        results = get_thread_pool(num_threads).map(analyze_plate, tasks)
+    else:
+        results = [analyze_plate(args) for args in tasks]
+
     data = dict()
+    for plate_name, plate in results:
+        if "error" in plate:
+            plate["filename"] = filename
+            return plate
+        data[plate_name] = plate
+    return data
 
-    for i, plate_name in zip(config["plate_indexes"], config["plate_names"]):
-        plate = data[plate_name] = dict()
-        plate[config["index_name"]] = index
-        plate_image = plate_images[i]
-        if i // 3 == 0:
-            calibration_plate = config["left_image"]
-            positions = config["left_positions"]
-        else:
-            calibration_plate = config["right_image"]
-            positions = config["right_positions"]
 
-        try:
-            edge_image = canny(plate_image, CANNY_SIGMA)
-            offset = align_plates(edge_image, calibration_plate)
-
-            # Add the offset to get the well centers in the analyzed plate.
-            well_centers = generate_well_centers(
-                np.array(positions) + offset, config["plate_size"], rows,
-                columns)
-            assert len(well_centers) == rows * columns
-            # Add a minimal value to avoid zero division.
-            plate_image /= (1 - plate_image + float_info.epsilon)
-
-            well_intensities = [find_well_intensity(plate_image, center)
-                                for center in well_centers]
-
-            for well, intensity in zip(well_names, well_intensities):
-                plate[well] = intensity
-        except (AttributeError, IndexError) as err:
-            return {"error": str(err), "filename": filename}
+def get_thread_pool(num_threads):
+    """
+    Return a thread pool of the given size that is reused across images.
 
-    return data
+    The pool is created lazily once per process. It is replaced if the size
+    changes or if it was inherited from a parent process by forking. The
+    current pool lives for the whole process and is shut down by the exit
+    hooks that `multiprocessing` registers for every pool.
+    """
+    pid = getpid()
+    if _THREAD_POOL["pid"] != pid or _THREAD_POOL["size"] != num_threads:
+        if _THREAD_POOL["pool"] is not None and _THREAD_POOL["pid"] == pid:
+            _THREAD_POOL["pool"].close()
+            _THREAD_POOL["pool"].join()
+        _THREAD_POOL["pool"] = ThreadPool(processes=num_threads)
+        _THREAD_POOL["pid"] = pid
+        _THREAD_POOL["size"] = num_threads
+    return _THREAD_POOL["pool"]
+
+
+def analyze_plate(args):
+    """
+    Analyze all wells of a single tray.
+
+    Independent of other trays such that it can run on a thread pool.
+    """
+    plate_image, i, plate_name, index, config = args
+    rows = config["rows"]
+    columns = config["columns"]
+    backend = config.get("backend", "numpy")
+    plate = dict()
+    plate[config["index_name"]] = index
+    if i // 3 == 0:
+        calibration_plate = config["left_image"]
+        positions = config["left_positions"]
+    else:
+        calibration_plate = config["right_image"]
+        positions = config["right_positions"]
+
+    try:
+        edge_image = canny(plate_image, CANNY_SIGMA)
+        offset = align_plates(edge_image, calibration_plate, backend)
+
+        # Add the offset to get the well centers in the analyzed plate.
+        well_centers = generate_well_centers(
+            np.array(positions) + offset, config["plate_size"], rows,
+            columns)
+        assert len(well_centers) == rows * columns
+        # Add a minimal value to avoid zero division.
+        plate_image /= (1 - plate_image + float_info.epsilon)
+
+        well_intensities = find_well_intensities(
+            plate_image, well_centers, backend=backend)
+
+        for well, intensity in zip(config["well_names"], well_intensities):
+            plate[well] = intensity
+    except (AttributeError, IndexError) as err:
+        return plate_name, {"error": str(err)}
+
+    return plate_name, plate
 
 
 def generate_well_centers(position, size, rows, columns):
@@ -245,3 +370,23 @@ def find_well_intensity(image, center, radius=4, n_mean=10):
     im_slice.sort()
     darkest = np.percentile(im_slice[:n_mean], 50)
     return darkest
+
+
+def find_well_intensities(image, centers, radius=4, n_mean=10,
+                          backend="numpy"):
+    """
+    Apply `find_well_intensity` to all given well centers.
+
+    With the numba backend all wells are processed in one compiled call
+    unless a well's window reaches beyond the image, in which case the
+    NumPy implementation is used to preserve its slicing behaviour.
+    """
+    centers = np.asarray(centers)
+    if kernels.resolve_backend(backend) == "numba" and len(centers) > 0 and \
+            0 < n_mean <= (2 * radius + 1) ** 2 and \
+            (centers - radius >= 0).all() and \
+            (centers + radius < image.shape[:2]).all():
+        darkest = kernels.darkest_pixels(image, centers, radius, n_mean)
+        return list(np.percentile(darkest, 50, axis=1))
+    return [find_well_intensity(image, center, radius, n_mean)
+            for center in centers]
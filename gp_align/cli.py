@@ -19,6 +19,7 @@
 
 from __future__ import absolute_import
 
+import json
 import logging
 from glob import glob
 from itertools import chain
@@ -32,6 +33,8 @@ from tqdm import tqdm
 
 from gp_align.analysis import analyze_run, PLATES
 from gp_align.conversion import g2od
+from gp_align.kernels import BACKENDS, resolve_backend
+from gp_align.screen import DEFAULT_RULES, configure_screen
 
 
 LOGGER = logging.getLogger(__name__.split(".", 1)[0])
@@ -83,9 +86,27 @@ def cli():
                    "or minute = m.")
 @click.option("--processes", "-p", type=int, default=NUM_CPU,
               show_default=True, help="Select the number of processes to use.")
+@click.option("--threads", "-t", type=int, default=1, show_default=True,
+              help="Select the number of threads per process that analyze "
+                   "the trays of one image concurrently. Useful for "
+                   "analyzing few images with low latency.")
+@click.option("--backend", type=click.Choice(BACKENDS), default="auto",
+              show_default=True,
+              help="The implementation of the numeric kernels. 'auto' uses "
+                   "numba if it is installed and numpy otherwise.")
+@click.option("--prescreen/--no-prescreen", default=True, show_default=True,
+              help="Skip blank, duplicate or corrupt images before the "
+                   "analysis.")
+@click.option("--screen-rule", "screen_rules", multiple=True,
+              metavar="RULE=VALUE",
+              help="Override a pre-screen rule, e.g., min_std=0.02. "
+                   "Thresholds are disabled with null and the PNG and "
+                   "duplicate checks with false. Can be given multiple "
+                   "times. Available rules: {}.".format(
+                       ", ".join(sorted(DEFAULT_RULES))))
 @click.argument("pattern", type=str, metavar="GLOB")
 def analyze(pattern, scanner, plate_type, orientation, out, trays,
-            time_unit, processes):
+            time_unit, processes, threads, backend, prescreen, screen_rules):
     """
     Analyze a series of images.
 
@@ -104,8 +125,31 @@ def analyze(pattern, scanner, plate_type, orientation, out, trays,
                 "'{}' contains invalid trays for scanner {}. "
                 "Please refer to the README.".format(trays, scanner))
 
+    rules = dict()
+    for rule in screen_rules:
+        key, sep, value = rule.partition("=")
+        if not sep or key.strip() not in DEFAULT_RULES:
+            raise click.BadParameter(
+                "'{}' is not of the form RULE=VALUE with a valid rule.".format(
+                    rule))
+        try:
+            rules[key.strip()] = json.loads(value)
+        except ValueError:
+            raise click.BadParameter(
+                "'{}' is not a valid value for rule '{}'.".format(value, key))
+    try:
+        configure_screen(rules)
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+    try:
+        resolve_backend(backend)
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+
     data = analyze_run(filenames, scanner, plate_type, orientation=orientation,
-                       plates=plates, unit=time_unit, num_proc=processes)
+                       plates=plates, unit=time_unit, num_proc=processes,
+                       backend=backend, num_threads=threads,
+                       prescreen=prescreen, screen_rules=rules)
 
     for name, df in iteritems(data):
         df.to_csv(out + "_" + name + ".G.tsv", sep="\t")
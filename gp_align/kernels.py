@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability,
+# Technical University of Denmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Provide optional compiled kernels for the numeric hot paths.
+
+If `numba` is installed, the kernels below are compiled on first use and
+release the GIL. Otherwise only the pure NumPy backend is available.
+"""
+
+from __future__ import absolute_import
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+NUMBA_AVAILABLE = njit is not None
+BACKENDS = ("auto", "numpy", "numba")
+
+
+def resolve_backend(backend="auto"):
+    """
+    Return the concrete backend name to use.
+
+    Parameters
+    ----------
+    backend : {"auto", "numpy", "numba"}, optional
+        The requested backend. "auto" selects numba when it is installed and
+        falls back to numpy otherwise.
+
+    Raises
+    ------
+    ValueError
+        If the backend is unknown or numba was requested but is missing.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(
+            "'{}' is an invalid backend. Choose one of {}.".format(
+                backend, ", ".join(BACKENDS)))
+    if backend == "auto":
+        return "numba" if NUMBA_AVAILABLE else "numpy"
+    if backend == "numba" and not NUMBA_AVAILABLE:
+        raise ValueError(
+            "The numba backend was requested but numba is not installed.")
+    return backend
+
+
+def _compare_images(image1, image2, x, y):
+    """Count overlapping white pixels of two uint8 (0/1) images with offset."""
+    x_start = max(0, x)
+    x_stop = min(image1.shape[0], image2.shape[0] + x)
+    y_start = max(0, y)
+    y_stop = min(image1.shape[1], image2.shape[1] + y)
+    overlap = 0
+    for i in range(x_start, x_stop):
+        row1 = image1[i, y_start:y_stop]
+        row2 = image2[i - x, y_start - y:y_stop - y]
+        # Branchless accumulation lets LLVM vectorize the inner loop.
+        for j in range(row1.shape[0]):
+            overlap += row1[j] & row2[j]
+    return overlap
+
+
+def _align_plates(image1, image2, radius):
+    """Return the offset (x, y) with the largest overlap within radius."""
+    best_x = 0
+    best_y = 0
+    best_value = 0
+    for i in range(-radius, radius + 1):
+        for j in range(-radius, radius + 1):
+            value = _compare_images(image1, image2, i, j)
+            if value > best_value:
+                best_value = value
+                best_x = i
+                best_y = j
+    return best_x, best_y
+
+
+def _darkest_pixels(image, centers, radius, n_mean):
+    """Collect the *n_mean* darkest pixels around each center (sorted)."""
+    width = 2 * radius + 1
+    result = np.empty((centers.shape[0], n_mean), dtype=image.dtype)
+    window = np.empty(width * width, dtype=image.dtype)
+    for k in range(centers.shape[0]):
+        x = centers[k, 0] - radius
+        y = centers[k, 1] - radius
+        for i in range(width):
+            for j in range(width):
+                window[i * width + j] = image[x + i, y + j]
+        result[k, :] = np.sort(window)[:n_mean]
+    return result
+
+
+if NUMBA_AVAILABLE:
+    _compare_images = njit(nogil=True, cache=True)(_compare_images)
+    _align_plates = njit(nogil=True, cache=True)(_align_plates)
+    _darkest_pixels = njit(nogil=True, cache=True)(_darkest_pixels)
+
+
+def _as_binary(image):
+    """Return a contiguous uint8 view of a boolean image without copying."""
+    return np.ascontiguousarray(image, dtype=np.bool_).view(np.uint8)
+
+
+def compare_images(image1, image2, x, y):
+    """Compiled equivalent of `gp_align.align.compare_images`."""
+    return int(_compare_images(_as_binary(image1), _as_binary(image2),
+                               int(x), int(y)))
+
+
+def align_plates(plate_image, calibration_plate, radius):
+    """Compiled equivalent of `gp_align.align.align_plates`."""
+    return np.asarray(_align_plates(_as_binary(plate_image),
+                                    _as_binary(calibration_plate),
+                                    int(radius)))
+
+
+def darkest_pixels(image, centers, radius, n_mean):
+    """
+    Return the sorted *n_mean* darkest pixels around each center.
+
+    All windows must lie completely within the image, which the caller is
+    expected to verify.
+    """
+    return _darkest_pixels(image, np.asarray(centers, dtype=np.int64),
+                           int(radius), int(n_mean))
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability,
+# Technical University of Denmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cheaply pre-screen scanner images before the full analysis.
+
+The scanner occasionally writes useless frames (lid open, lamp failure,
+all-black, truncated or duplicated files). File level checks run before
+an image is decoded and intensity checks run on a downsampled version of
+the decoded image, such that rejected frames skip edge detection and
+alignment entirely. The size and intensity thresholds can be disabled by
+setting them to ``None``, the file checks by setting them to ``False``.
+``downsample`` and ``histogram_bins`` are settings rather than rules and
+always require a positive integer.
+"""
+
+from __future__ import absolute_import, division
+
+import hashlib
+import numbers
+import struct
+from collections import OrderedDict
+from os.path import getsize, splitext
+
+import numpy as np
+from six import iteritems, itervalues
+from skimage import img_as_float
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_END = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+DEFAULT_RULES = {
+    # Files smaller than this many bytes are rejected.
+    "min_file_size": 1024,
+    # Validate the signature, header and end chunk of PNG files.
+    "check_png": True,
+    # Reject files that are byte-identical to an earlier scan.
+    "reject_duplicates": True,
+    # Use only every n-th pixel along each axis for the intensity checks.
+    "downsample": 8,
+    # Number of bins of the intensity histogram over [0, 1].
+    "histogram_bins": 20,
+    # Maximum fraction of pixels in the darkest histogram bin.
+    "max_dark_fraction": 0.95,
+    # Maximum fraction of pixels in the brightest histogram bin.
+    "max_bright_fraction": 0.95,
+    # Minimum standard deviation of the downsampled intensities.
+    "min_std": 0.01,
+}
+
+
+def configure_screen(rules=None):
+    """
+    Return the complete set of pre-screen rules.
+
+    Parameters
+    ----------
+    rules : dict, optional
+        Rules that override the entries of `DEFAULT_RULES`.
+
+    Raises
+    ------
+    ValueError
+        If an unknown rule or an invalid value is given.
+    """
+    config = dict(DEFAULT_RULES)
+    if rules is None:
+        return config
+    for key, value in iteritems(rules):
+        if key not in DEFAULT_RULES:
+            raise ValueError(
+                "'{}' is not a valid pre-screen rule. Choose from {}.".format(
+                    key, ", ".join(sorted(DEFAULT_RULES))))
+        check_rule(key, value)
+        config[key] = value
+    return config
+
+
+def check_rule(key, value):
+    """Raise a `ValueError` if the value is not valid for the given rule."""
+    is_integer = isinstance(value, numbers.Integral) and \
+        not isinstance(value, bool)
+    is_real = isinstance(value, numbers.Real) and not isinstance(value, bool)
+    if key in ("check_png", "reject_duplicates"):
+        valid = isinstance(value, bool)
+        expected = "true or false"
+    elif key in ("downsample", "histogram_bins"):
+        valid = is_integer and value > 0
+        expected = "a positive integer"
+    elif key == "min_file_size":
+        valid = value is None or (is_integer and value >= 0)
+        expected = "a non-negative integer or null"
+    elif key in ("max_dark_fraction", "max_bright_fraction"):
+        valid = value is None or (is_real and 0 <= value <= 1)
+        expected = "a fraction between 0 and 1 or null"
+    else:
+        valid = value is None or (is_real and value >= 0)
+        expected = "a non-negative number or null"
+    if not valid:
+        raise ValueError(
+            "'{}' is not a valid value for the pre-screen rule '{}'. "
+            "Expected {}.".format(value, key, expected))
+
+
+def screen_files(filenames, rules, key=None):
+    """
+    Apply the file level rules to a series of images.
+
+    Parameters
+    ----------
+    filenames : iterable
+        Image file names. Repeated paths are only considered once.
+    rules : dict
+        The pre-screen rules as returned by `configure_screen`.
+    key : callable, optional
+        Sort key that orders the images chronologically. Of byte-identical
+        images only the first one in this order is kept.
+
+    Returns
+    -------
+    tuple
+        A list of accepted file names (in the given order) and a list of
+        pairs of rejected file names and their reasons.
+    """
+    filenames = list(OrderedDict.fromkeys(filenames))
+    rejected = dict()
+    sizes = dict()
+    for filename in filenames:
+        try:
+            reason, size = screen_file(filename, rules)
+        except (IOError, OSError) as err:
+            reason, size = str(err), None
+        if reason is not None:
+            rejected[filename] = reason
+        else:
+            sizes.setdefault(size, list()).append(filename)
+    if rules["reject_duplicates"]:
+        # Byte-identical files have the same size, so only those are hashed.
+        for candidates in itervalues(sizes):
+            if len(candidates) < 2:
+                continue
+            digests = dict()
+            for filename in candidates:
+                try:
+                    digest = file_digest(filename)
+                except (IOError, OSError) as err:
+                    rejected[filename] = str(err)
+                    continue
+                digests.setdefault(digest, list()).append(filename)
+            for duplicates in itervalues(digests):
+                duplicates = sorted(duplicates, key=key)
+                for filename in duplicates[1:]:
+                    rejected[filename] = \
+                        "byte-identical duplicate of '{}'".format(
+                            duplicates[0])
+    accepted = [f for f in filenames if f not in rejected]
+    return accepted, [(f, rejected[f]) for f in filenames if f in rejected]
+
+
+def screen_file(filename, rules):
+    """
+    Check a single image file without decoding it.
+
+    Only the size and, for PNG files, the first and last few bytes are
+    inspected.
+
+    Returns
+    -------
+    tuple
+        The reason for rejection or None and the file size in bytes.
+    """
+    size = getsize(filename)
+    min_size = rules["min_file_size"]
+    if min_size is not None and size < min_size:
+        return "file size of {:d} bytes is below {:d}".format(
+            size, min_size), size
+    if rules["check_png"] and splitext(filename)[1].lower() == ".png":
+        with open(filename, "rb") as file_handle:
+            header = file_handle.read(24)
+            trailer = b""
+            if size >= len(PNG_END):
+                file_handle.seek(-len(PNG_END), 2)
+                trailer = file_handle.read()
+        return check_png(header, trailer), size
+    return None, size
+
+
+def check_png(header, trailer):
+    """Return the reason if the first and last bytes are not a PNG file's."""
+    if not header.startswith(PNG_SIGNATURE):
+        return "invalid PNG signature"
+    # The IHDR chunk must come first and contain a non-empty image.
+    chunk = header[8:24]
+    if len(chunk) < 16 or chunk[4:8] != b"IHDR":
+        return "missing PNG header"
+    width, height = struct.unpack(">II", chunk[8:16])
+    if width == 0 or height == 0:
+        return "empty PNG image of {:d}x{:d} pixels".format(width, height)
+    if trailer != PNG_END:
+        return "truncated PNG file"
+    return None
+
+
+def file_digest(filename, chunk_size=1 << 20):
+    """Return the MD5 hex digest of a file read in chunks."""
+    digest = hashlib.md5()
+    with open(filename, "rb") as file_handle:
+        for chunk in iter(lambda: file_handle.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def screen_image(image, rules):
+    """
+    Check the intensities of a decoded gray scale image.
+
+    Returns
+    -------
+    str or None
+        The reason for rejection or None if the image passes.
+    """
+    step = rules["downsample"]
+    sample = img_as_float(image[::step, ::step])
+    max_dark = rules["max_dark_fraction"]
+    max_bright = rules["max_bright_fraction"]
+    if max_dark is not None or max_bright is not None:
+        counts, _ = np.histogram(sample, bins=rules["histogram_bins"],
+                                 range=(0.0, 1.0))
+        fractions = counts / sample.size
+        if max_dark is not None and fractions[0] > max_dark:
+            return "{:.1%} of pixels are dark (lamp failure or black " \
+                   "frame)".format(fractions[0])
+        if max_bright is not None and fractions[-1] > max_bright:
+            return "{:.1%} of pixels are bright (lid open or " \
+                   "overexposed)".format(fractions[-1])
+    min_std = rules["min_std"]
+    if min_std is not None:
+        std = sample.std()
+        if std < min_std:
+            return "nearly uniform intensity (std {:.4f})".format(std)
+    return None